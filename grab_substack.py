@@ -1,30 +1,154 @@
+import functools
 import hashlib
 import json
 import os
 import re
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
 from urllib.parse import urljoin, urlparse
 
 import requests
-from bs4 import BeautifulSoup
-
-FOOTNOTES = {}
+from bs4 import BeautifulSoup, Comment, FeatureNotFound
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # Optional, falls back to the stdlib json module
+    orjson = None
+
+IMAGE_FOLDER = "images"
+
+# Local paths of images fetched ahead of rendering, keyed by (folder, absolute URL)
+DOWNLOADED_IMAGES = {}
+
+# File extensions for image content types
+IMAGE_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/jpg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+    "image/svg+xml": ".svg",
+}
+
+# Background downloads started by prefetch_images, keyed by (folder, absolute URL)
+PENDING_IMAGES = {}
+IMAGE_POOL = ThreadPoolExecutor(max_workers=8)
+
+# Image folders already created during this run, each mapped to the images
+# saved there by earlier runs (URL hash -> path)
+READY_FOLDERS = {}
+
+# Guards the image caches above, which concurrent scrapes share
+IMAGE_LOCK = threading.Lock()
+
+# Saved images get the permissions open() would give them under the umask,
+# which is read once here while nothing else can be changing it
+_umask = os.umask(0)
+os.umask(_umask)
+IMAGE_FILE_MODE = 0o666 & ~_umask
+
+# Shared session so the page and its images reuse pooled keep-alive connections
+SESSION = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=16,
+    # Once retries run out, hand back the last response so raise_for_status
+    # reports the HTTP error rather than a RetryError
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        raise_on_status=False,
+    ),
+)
+SESSION.mount("http://", _adapter)
+SESSION.mount("https://", _adapter)
+
+# Patterns used while scraping, compiled once
+FOOTNOTE_NUM_RE = re.compile(r"^\[?\d+\]?\s*")
+BACKREF_CLASS_RE = re.compile(r"backref|footnote-back", re.I)
+AUTHOR_CLASS_RE = re.compile("author|byline", re.I)
+UNSAFE_FILENAME_RE = re.compile(r"[^\w\s-]")
+FILENAME_SEPARATOR_RE = re.compile(r"[-\s]+")
+
+# Elements removed from the article body before rendering - Generic & Substack
+UNWANTED_CLASSES = frozenset(
+    [
+        # Substack
+        "share-dialog-title",
+        "share-button",
+        "subscription-widget-wrap",
+        "subscribe-widget",
+        "post-footer",
+        "comments-section",
+        "buttons",
+        "utility-bar",
+        "paywall-cta",
+        "share-post",
+        "post-footer-cta",
+        # Generic
+        "sidebar",
+        "hide--s",  # Mobile-specific content in Quanta
+        "nav",
+        "navigation",
+        "footer",
+        "menu",
+        "ad",
+        "advertisement",
+        "popup",
+        "newsletter-signup",
+    ]
+)
+# Containers skipped while rendering (print navigation, headers, sidebars)
+PRINT_EXCLUDED_CLASSES = frozenset(
+    [
+        "print-nav",
+        "series-nav",
+        "post__title__wrapper",  # Contains Duplicate Title, Author, Date, Tags
+        "post__sidebar",  # Contains Author Profile, Share Buttons
+        "footer__wrapper",  # Contains Footer/Newsletter
+        "d-print-none",  # Generic print hider
+        "hide-on-print",  # Quanta specific print hider
+        "podcast",  # Exclude podcast player
+        "social-links",  # Exclude social sharing
+        "sidebar__actions",  # Exclude sidebar actions (print button)
+        "sidebar__tag-wrap",  # Exclude sidebar tags
+    ]
+)
+CLEANUP_KEYWORDS = ("subscribe", "share", "leave a comment", "donate", "sign up")
 
 
 def clean_text(text):
     return text.strip()
 
 
+# Escape characters special in Typst
+TYPST_ESCAPE = str.maketrans({c: "\\" + c for c in "*_`$#[]<>@"})
+
+
 def escape_typst(text):
-    # Escape characters special in Typst
-    chars = ["*", "_", "`", "$", "#", "[", "]", "<", ">", "@"]
-    for char in chars:
-        text = text.replace(char, "\\" + char)
-    return text
+    return text.translate(TYPST_ESCAPE)
 
 
+# Fallback date formats, each guarded by a cheap shape check so that only
+# the matching strptime call is attempted
+DATE_FORMATS = [
+    (re.compile(r"^[A-Za-z]{3}\s+\d{1,2},\s+\d{4}$"), "%b %d, %Y"),  # Nov 26, 2025
+    (re.compile(r"^[A-Za-z]+\s+\d{1,2},\s+\d{4}$"), "%B %d, %Y"),  # November 26, 2025
+    (re.compile(r"^\d{1,2}\s+[A-Za-z]{3}\s+\d{4}$"), "%d %b %Y"),  # 26 Nov 2025
+    (re.compile(r"^\d{4}-\d{1,2}-\d{1,2}$"), "%Y-%m-%d"),  # 2025-11-26
+]
+
+
+@functools.lru_cache(maxsize=1024)
 def format_date(date_string):
     if not date_string:
         return ""
@@ -44,15 +168,10 @@ def format_date(date_string):
         except ValueError:
             pass
 
-    formats = [
-        "%b %d, %Y",  # Nov 26, 2025
-        "%B %d, %Y",  # November 26, 2025
-        "%d %b %Y",  # 26 Nov 2025
-        "%Y-%m-%d",  # 2025-11-26
-    ]
-
     if not dt:
-        for fmt in formats:
+        for pattern, fmt in DATE_FORMATS:
+            if not pattern.match(date_string):
+                continue
             try:
                 dt = datetime.strptime(date_string, fmt)
                 break
@@ -67,114 +186,311 @@ def format_date(date_string):
     return date_string
 
 
-def download_image(url, folder="images"):
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-
+def ensure_folder(folder):
+    # Create and index each image folder once per process rather than per image
+    with IMAGE_LOCK:
+        if folder not in READY_FOLDERS:
+            os.makedirs(folder, exist_ok=True)
+            READY_FOLDERS[folder] = {
+                os.path.splitext(name)[0]: os.path.join(folder, name)
+                for name in os.listdir(folder)
+                if not name.startswith(".")
+            }
+        return READY_FOLDERS[folder]
+
+
+def download_image(url, folder=IMAGE_FOLDER):
+    # Reuse the prefetched result, or an earlier download of the same URL.
+    # A download still in flight is waited on rather than fetched twice, so
+    # every caller of a URL is handed the same future.
+    key = (folder, url)
+    with IMAGE_LOCK:
+        if key in DOWNLOADED_IMAGES:
+            return DOWNLOADED_IMAGES[key]
+        pending = PENDING_IMAGES.get(key)
+        if pending is None:
+            pending = IMAGE_POOL.submit(fetch_image, url, folder)
+            PENDING_IMAGES[key] = pending
+
+    path = pending.result()
+    with IMAGE_LOCK:
+        DOWNLOADED_IMAGES[key] = path
+        PENDING_IMAGES.pop(key, None)
+    return path
+
+
+@functools.lru_cache(maxsize=4096)
+def image_key(url):
+    # Use simple hash for filename to avoid issues
+    return hashlib.blake2b(url.encode(), digest_size=8).hexdigest()
+
+
+def fetch_image(url, folder=IMAGE_FOLDER):
+    key = image_key(url)
+
+    # Skip the request entirely if a previous run already saved this image
+    existing = ensure_folder(folder).get(key)
+    if existing:
+        return existing
+
+    tmp_path = None
     try:
-        response = requests.get(url, stream=True)
-        response.raise_for_status()
+        # Closing the response returns its connection to the pool even when
+        # the download fails part way
+        with SESSION.get(url, stream=True) as response:
+            response.raise_for_status()
+
+            # Look for format in content-type (media type without parameters)
+            ct = response.headers.get("content-type", "").lower()
+            ext = IMAGE_EXTENSIONS.get(ct.partition(";")[0].strip(), "")
+
+            if not ext:
+                # Fallback to extension in URL
+                ext = os.path.splitext(urlparse(url).path)[1]
 
-        # Create a safe filename from the URL
-        parsed = urlparse(url)
-        path = parsed.path
-
-        # Look for format in content-type
-        ct = response.headers.get("content-type", "").lower()
-        ext = ""
-        if "image/jpeg" in ct or "image/jpg" in ct:
-            ext = ".jpg"
-        elif "image/png" in ct:
-            ext = ".png"
-        elif "image/gif" in ct:
-            ext = ".gif"
-        elif "image/webp" in ct:
-            ext = ".webp"
-        elif "image/svg+xml" in ct:
-            ext = ".svg"
-
-        if not ext:
-            # Fallback to extension in URL
-            ext = os.path.splitext(path)[1]
-
-        if not ext:
-            ext = ".jpg"  # Final fallback
-
-        # Use simple hash for filename to avoid issues
-        filename = hashlib.md5(url.encode()).hexdigest() + ext
-        filepath = os.path.join(folder, filename)
-
-        with open(filepath, "wb") as f:
-            for chunk in response.iter_content(1024):
-                f.write(chunk)
+            if not ext:
+                ext = ".jpg"  # Final fallback
+
+            filepath = os.path.join(folder, key + ext)
+
+            # Write under a unique hidden temporary name, so an interrupted
+            # download is never mistaken for a cached image on the next run
+            # and concurrent writers never share a file
+            fd, tmp_path = tempfile.mkstemp(
+                dir=folder, prefix=f".{key}.", suffix=".part"
+            )
+            # Copy straight from the socket in 64 KiB blocks, still undoing any
+            # Content-Encoding the server applied
+            response.raw.decode_content = True
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(response.raw, f, length=64 * 1024)
+            # mkstemp creates the file readable by its owner only
+            os.chmod(tmp_path, IMAGE_FILE_MODE)
+            os.replace(tmp_path, filepath)
 
         return filepath
     except Exception as e:
         print(f"Failed to download image: {url}, error: {e}")
+        # Don't leave a partial download behind
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
         return None
 
 
-def html_to_typst(element, base_url=""):
-    if element.name is None:
-        return escape_typst(element)
+def is_footnote_id(value):
+    # Substring test instead of a regex search on every id attribute
+    return value is not None and "footnote-" in value
 
-    if element.name in ["script", "style", "noscript"]:
-        return ""
 
-    # Exclude print-specific navigation and headers
-    if element.name in ["div", "section", "aside"] and any(
-        cls in element.get("class", [])
-        for cls in [
-            "print-nav",
-            "series-nav",
-            "post__title__wrapper",  # Contains Duplicate Title, Author, Date, Tags
-            "post__sidebar",  # Contains Author Profile, Share Buttons
-            "footer__wrapper",  # Contains Footer/Newsletter
-            "d-print-none",  # Generic print hider
-            "hide-on-print",  # Quanta specific print hider
-            "podcast",  # Exclude podcast player
-            "social-links",  # Exclude social sharing
-            "sidebar__actions",  # Exclude sidebar actions (print button)
-            "sidebar__tag-wrap",  # Exclude sidebar tags
-        ]
-    ):
-        return ""
+def has_text_longer_than(element, limit):
+    # Same as len(element.get_text(strip=True)) > limit, but stops reading
+    # strings as soon as the limit is passed
+    total = 0
+    for text in element.stripped_strings:
+        total += len(text)
+        if total > limit:
+            return True
+    return False
 
-    # Exclude specific buttons and legacy hidden elements
-    if element.name == "button" and "bookmark-button" in element.get("class", []):
-        return ""
-    if "hidden" in element.get("class", []):
+
+def is_caption_class(value):
+    return value and "caption" in value
+
+
+def is_attribution_class(value):
+    return value and "attribution" in value
+
+
+def load_json(text):
+    if orjson is None:
+        return json.loads(text)
+    # orjson only accepts exact str/bytes, not subclasses like NavigableString
+    if type(text) not in (str, bytes):
+        text = str(text)
+    return orjson.loads(text)
+
+
+def load_json_ld(soup):
+    blocks = []
+    for script in soup.find_all("script", type="application/ld+json"):
+        try:
+            blocks.append(load_json(script.string))
+        except:
+            pass
+    return blocks
+
+
+def parse_html(markup, encoding=None):
+    # Prefer the C-backed lxml parser, fall back to the stdlib one.
+    # A known encoding lets BeautifulSoup skip sniffing the bytes for one.
+    try:
+        return BeautifulSoup(markup, "lxml", from_encoding=encoding)
+    except FeatureNotFound:
+        return BeautifulSoup(markup, "html.parser", from_encoding=encoding)
+
+
+def strip_non_content(element):
+    for tag in element.find_all(["script", "style", "noscript", "template"]):
+        tag.decompose()
+    for comment in element.find_all(string=lambda t: isinstance(t, Comment)):
+        comment.extract()
+
+
+def is_skipped(element):
+    # Print-specific navigation, headers and hidden elements are left out of
+    # the rendering together with their children
+    name = element.name
+    classes = element.get("class")
+    if classes:
+        # Exclude print-specific navigation and headers
+        excluded = not PRINT_EXCLUDED_CLASSES.isdisjoint(classes)
+        if excluded and name in ["div", "section", "aside"]:
+            return True
+
+        # Exclude specific buttons and legacy hidden elements
+        if name == "button" and "bookmark-button" in classes:
+            return True
+        if "hidden" in classes:
+            return True
+
+    return name == "header"
+
+
+def figure_media_src(figure):
+    # Source of the image shown for a figure, falling back to a video's
+    # poster (used for print) and then the video itself
+    img = figure.find("img")
+    if img:
+        return img.get("src") or img.get("data-src")
+    video = figure.find("video")
+    if video:
+        return video.get("poster") or video.get("src")
+    return None
+
+
+def datawrapper_thumbnail(element):
+    # Thumbnail URL and parsed data-attrs of a Datawrapper embed. Raises
+    # ValueError when data-attrs is not a JSON object.
+    attrs = load_json(element["data-attrs"])
+    if not isinstance(attrs, dict):
+        raise ValueError("data-attrs is not a JSON object")
+    return attrs.get("thumbnail_url") or attrs.get("thumbnail_url_full"), attrs
+
+
+def footnote_fragment(href):
+    # Id of the footnote a link points to, or "" for any other link.
+    # Only the fragment is needed, so split on "#" instead of using urlparse
+    fragment = href.partition("#")[2]
+    return fragment if "footnote" in fragment else ""
+
+
+def collect_image_urls(element, base_url="", footnote_refs=None):
+    # Walk the elements render_start would reach, using the same helpers, so
+    # the images the render walk asks for can be fetched up front. Footnotes
+    # linked along the way are added to footnote_refs.
+    urls = []
+    stack = [(element, False)]
+    while stack:
+        node, is_item = stack.pop()
+        name = node.name
+        classes = node.get("class")
+
+        # List items are rendered without render_start, so nothing is skipped
+        if not is_item:
+            if is_skipped(node):
+                continue
+
+            if name == "figure" and not node.find("figure"):
+                src = figure_media_src(node)
+                if src:
+                    urls.append(src)
+                    continue
+                if node.find("lottie-player"):
+                    continue
+
+            if name == "div" and classes and "datawrapper-wrap" in classes:
+                if node.has_attr("data-attrs"):
+                    try:
+                        img_url, _ = datawrapper_thumbnail(node)
+                    except ValueError:
+                        img_url = None
+                    # The children are still walked: they are rendered
+                    # instead if the thumbnail fails to download
+                    if img_url:
+                        urls.append(img_url)
+
+            if name == "a" and footnote_refs is not None:
+                fid = footnote_fragment(node.get("href", ""))
+                if fid:
+                    footnote_refs.append(fid)
+
+            # Standalone images are rendered from src only
+            if name == "img":
+                src = node.get("src")
+                if src:
+                    urls.append(src)
+
+        children = node.find_all(True, recursive=False)
+        if name in ["ul", "ol"]:
+            children = [child for child in children if child.name == "li"]
+        for child in reversed(children):
+            stack.append((child, name in ["ul", "ol"]))
+
+    if base_url:
+        urls = [urljoin(base_url, u) for u in urls]
+    return [u for u in urls if u.startswith("http")]
+
+
+def prefetch_images(urls, folder=IMAGE_FOLDER):
+    # Start the downloads in the background; download_image collects each one
+    # when rendering reaches it, so the rest of the scrape overlaps the network
+    ensure_folder(folder)
+
+    with IMAGE_LOCK:
+        for url in urls:
+            key = (folder, url)
+            if key not in DOWNLOADED_IMAGES and key not in PENDING_IMAGES:
+                PENDING_IMAGES[key] = IMAGE_POOL.submit(fetch_image, url, folder)
+
+
+@dataclass
+class RenderContext:
+    # Per-article state shared by the render functions
+    base_url: str = ""
+    # Rendered footnotes by id (without the leading #)
+    footnotes: dict = field(default_factory=dict)
+    # Footnote definitions not rendered yet: id -> (element, strip leading number)
+    footnote_sources: dict = field(default_factory=dict)
+
+
+def render_start(element, ctx):
+    # Opening half of html_to_typst: returns the finished output for elements
+    # rendered without their children, or None to descend into them
+    base_url = ctx.base_url
+    name = element.name
+    if name is None:
+        return escape_typst(element)
+
+    if is_skipped(element):
         return ""
 
+    classes = element.get("class")
+
     # Explicit Figure Handling
-    if element.name == "figure":
+    if name == "figure":
         # Check if this figure contains another figure (nested wrappers).
-        # If so, treat as container and recurse.
+        # If so, treat as container and descend.
         if element.find("figure"):
-            content = ""
-            for child in element.children:
-                content += html_to_typst(child, base_url)
-            return content
+            return None
 
         # Determine media source
         img = element.find("img")
-        video = element.find("video")
         lottie = element.find("lottie-player")
-
-        target_src = None
-        if img:
-            target_src = img.get("src") or img.get("data-src")
-        elif video:
-            target_src = video.get("poster")  # Use poster for print
-            if not target_src:
-                target_src = video.get("src")
+        target_src = figure_media_src(element)
 
         # If no media found, maybe it's a code block or just a container?
         if not target_src and not lottie:
-            content = ""
-            for child in element.children:
-                content += html_to_typst(child, base_url)
-            return content
+            return None
 
         local_path = None
         if target_src:
@@ -200,8 +516,8 @@ def html_to_typst(element, base_url=""):
 
         # Parse flexible caption structure
         # 1. Look for explicit classes (Quanta style)
-        caption_div = search_root.find(class_=lambda x: x and "caption" in x)
-        attribution_div = search_root.find(class_=lambda x: x and "attribution" in x)
+        caption_div = search_root.find(class_=is_caption_class)
+        attribution_div = search_root.find(class_=is_attribution_class)
 
         if caption_div:
             caption_text = caption_div.get_text(" ", strip=True)
@@ -237,14 +553,10 @@ def html_to_typst(element, base_url=""):
 
         return ""  # Failed to download or process
 
-    if element.name == "header":
-        return ""
-
-    if element.name == "div" and "datawrapper-wrap" in element.get("class", []):
+    if name == "div" and classes and "datawrapper-wrap" in classes:
         if element.has_attr("data-attrs"):
             try:
-                attrs = json.loads(element["data-attrs"])
-                img_url = attrs.get("thumbnail_url") or attrs.get("thumbnail_url_full")
+                img_url, attrs = datawrapper_thumbnail(element)
                 if img_url:
                     if base_url:
                         img_url = urljoin(base_url, img_url)
@@ -265,155 +577,238 @@ def html_to_typst(element, base_url=""):
             except Exception as e:
                 print(f"Error parsing datawrapper: {e}")
 
-    content = ""
-    for child in element.children:
-        content += html_to_typst(child, base_url)
-
-    if element.name in ["p", "div", "aside"]:
-        # Avoid empty paragraphs
-        if not content.strip() and not element.find("img"):
-            return ""
-        return f"{content}\n\n"
-    elif element.name in ["h1", "h2", "h3", "h4", "h5", "h6"]:
-        level = int(element.name[1])
-        return f"{'=' * level} {content}\n\n"
-    elif element.name == "strong" or element.name == "b":
-        if not content.strip():
-            return ""
-        return f"#strong[{content}]"
-    elif element.name == "em" or element.name == "i":
-        if not content.strip():
-            return ""
-        return f"#emph[{content}]"
-    elif element.name == "ul":
-        # Process list items
-        items = [child for child in element.children if child.name == "li"]
-        result = ""
-        for item in items:
-            item_content = ""
-            for child in item.children:
-                item_content += html_to_typst(child, base_url)
-            result += f"- {item_content.strip()}\n"
-        return result + "\n"
-    elif element.name == "ol":
-        # Process list items
-        items = [child for child in element.children if child.name == "li"]
-        result = ""
-        for item in items:
-            item_content = ""
-            for child in item.children:
-                item_content += html_to_typst(child, base_url)
-            result += f"+ {item_content.strip()}\n"
-        return result + "\n"
-    elif element.name == "blockquote":
-        return f"#quote(block: true)[{content}]\n\n"
-    elif element.name == "br":
-        return "\n"
-    elif element.name == "a":
-        href = element.get("href", "")
-        # Resolve relative URLs
-        if href and base_url:
-            href = urljoin(base_url, href)
-
-        # Special case: Image wrapped in link
-        if element.find("img"):
-            return content  # Just return the content (the image) without the link wrapper for cleaner print
-
-        # Check if content is just an image filename (common artifact in converted footnotes/captions)
-        text_content = element.get_text().strip().lower()
-        if (
-            text_content.endswith((".jpg", ".jpeg", ".png", ".gif", ".webp"))
-            and len(text_content) < 50
-        ):
-            return ""
-
-        # Check for absolute URLs that point to fragments
-        parsed_href = urlparse(href)
-        # If fragment exists and looks like a footnote
-        if parsed_href.fragment and (
-            parsed_href.fragment.startswith("footnote")
-            or "footnote" in parsed_href.fragment
-        ):
-            fragment = "#" + parsed_href.fragment
-            # Try to resolve content
-            fn_content = FOOTNOTES.get(fragment)
-            if not fn_content:
-                # Try partial match (sometimes ids vary slightly)
-                # or just the id without #
-                fn_content = FOOTNOTES.get(parsed_href.fragment)
-
-            if fn_content:
-                return f"#footnote[{fn_content.strip()}]"
-
-            # If we think it IS a footnote but we missed the content (maybe dynamic?),
-            # Try to just print text.
-            # But safer is to return the link if content missing?
-            # Or assume the content is elsewhere?
-
-            # Use text as number if it is a number
-            text_content = element.get_text().strip()
-            if text_content.isdigit() or (
-                text_content.startswith("[") and text_content.endswith("]")
-            ):
-                # It's a reference number
-                # If we don't have content, maybe we shouldn't make it a footnote?
-                # formatting it as SUPER avoids the big blue link.
-                return f"#super[{text_content}]"
-
-        return f'#link("{href}")[{content}]'
-    elif element.name == "img":
-        src = element.get("src")
-        if src:
-            if base_url:
-                src = urljoin(base_url, src)
-            local_path = download_image(src)
-            if local_path:
-                return f'#figure(image("{local_path}"), caption: [])\n\n'
+    return None
+
+
+def render_paragraph(element, content, ctx, children):
+    # Avoid empty paragraphs
+    if not content.strip() and not children.has_img():
         return ""
+    return f"{content}\n\n"
 
-    return content
 
+def render_heading(element, content, ctx, children):
+    level = int(element.name[1])
+    return f"{'=' * level} {content}\n\n"
 
-def scrape_url(url):
-    # Special handling for Quanta Magazine - force print mode
-    if "quantamagazine.org" in url and "print=1" not in url:
-        if "?" in url:
-            url += "&print=1"
-        else:
-            url += "?print=1"
-        print(f"Switching to print mode: {url}")
 
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
-    }
+def render_strong(element, content, ctx, children):
+    if not content.strip():
+        return ""
+    return f"#strong[{content}]"
 
-    # Check for Substack session cookie in environment variables
-    # You can set this by running: export SUBSTACK_COOKIE="...your_cookie_value..."
-    cookie_value = os.environ.get("SUBSTACK_COOKIE")
-    cookies = {}
-    if cookie_value:
-        cookies["substack.sid"] = cookie_value
-        print("Using provided SUBSTACK_COOKIE for authentication.")
 
-    if os.path.exists(url):
-        print(f"Reading local file: {url}")
-        with open(url, "r", encoding="utf-8") as f:
-            content = f.read()
-        soup = BeautifulSoup(content, "html.parser")
-        # Try to find canonical URL for base_url
-        canonical = soup.find("link", rel="canonical")
-        if canonical and canonical.get("href"):
-            url = canonical.get(
-                "href"
-            )  # Update url var to be the remote one for resolving relative links
-    else:
-        response = requests.get(url, headers=headers, cookies=cookies)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.content, "html.parser")
+def render_emph(element, content, ctx, children):
+    if not content.strip():
+        return ""
+    return f"#emph[{content}]"
+
+
+def render_list(element, content, ctx, children):
+    return content + "\n"
+
+
+def render_quote(element, content, ctx, children):
+    return f"#quote(block: true)[{content}]\n\n"
+
+
+def render_break(element, content, ctx, children):
+    return "\n"
+
+
+def footnote_content(fid, ctx):
+    # Render a footnote definition the first time it is referenced
+    footnotes = ctx.footnotes
+    if fid not in footnotes:
+        source = ctx.footnote_sources.pop(fid, None)
+        if source is None:
+            return None
+        element, strip_number = source
+        content = html_to_typst(element, ctx)
+        if strip_number:
+            content = FOOTNOTE_NUM_RE.sub("", content)
+        footnotes[fid] = content
+    return footnotes[fid]
+
+
+def render_link(element, content, ctx, children):
+    base_url = ctx.base_url
+    href = element.get("href", "")
+    # Resolve relative URLs
+    if href and base_url:
+        href = urljoin(base_url, href)
+
+    # Special case: Image wrapped in link
+    if children.has_img():
+        return content  # Just return the content (the image) without the link wrapper for cleaner print
+
+    # Check if content is just an image filename (common artifact in converted footnotes/captions)
+    link_text = element.get_text().strip()
+    text_content = link_text.lower()
+    if (
+        text_content.endswith((".jpg", ".jpeg", ".png", ".gif", ".webp"))
+        and len(text_content) < 50
+    ):
+        return ""
+
+    # Check for absolute URLs that point to fragments
+    fragment = footnote_fragment(href)
+    # If fragment exists and looks like a footnote
+    if fragment:
+        # Try to resolve content (stored by id, without the leading #)
+        fn_content = footnote_content(fragment, ctx)
+
+        if fn_content:
+            return f"#footnote[{fn_content.strip()}]"
+
+        # If we think it IS a footnote but we missed the content (maybe dynamic?),
+        # Try to just print text.
+        # But safer is to return the link if content missing?
+        # Or assume the content is elsewhere?
+
+        # Use text as number if it is a number
+        text_content = link_text
+        if text_content.isdigit() or (
+            text_content.startswith("[") and text_content.endswith("]")
+        ):
+            # It's a reference number
+            # If we don't have content, maybe we shouldn't make it a footnote?
+            # formatting it as SUPER avoids the big blue link.
+            return f"#super[{text_content}]"
+
+    return f'#link("{href}")[{content}]'
+
+
+def render_image(element, content, ctx, children):
+    base_url = ctx.base_url
+    src = element.get("src")
+    if src:
+        if base_url:
+            src = urljoin(base_url, src)
+        local_path = download_image(src)
+        if local_path:
+            return f'#figure(image("{local_path}"), caption: [])\n\n'
+    return ""
+
+
+# Closing handlers by tag name; other tags pass their content through
+END_HANDLERS = {
+    "p": render_paragraph,
+    "div": render_paragraph,
+    "aside": render_paragraph,
+    "h1": render_heading,
+    "h2": render_heading,
+    "h3": render_heading,
+    "h4": render_heading,
+    "h5": render_heading,
+    "h6": render_heading,
+    "strong": render_strong,
+    "b": render_strong,
+    "em": render_emph,
+    "i": render_emph,
+    "ul": render_list,
+    "ol": render_list,
+    "blockquote": render_quote,
+    "br": render_break,
+    "a": render_link,
+    "img": render_image,
+}
+
+
+def render_end(element, content, ctx, children, marker=None):
+    # Closing half of html_to_typst: wraps the rendered children of an element
+    if marker:
+        # List item inside ul/ol
+        return f"{marker} {content.strip()}\n"
+
+    handler = END_HANDLERS.get(element.name)
+    if handler is None:
+        return content
+    return handler(element, content, ctx, children)
+
+
+class RenderedChildren:
+    # Output of an element's children during the html_to_typst walk, plus
+    # whether any <img> lies below it, so handlers need not search for one
+    __slots__ = ("parts", "img_found", "unscanned")
+
+    def __init__(self):
+        self.parts = []
+        self.img_found = False
+        # Subtrees rendered without being walked; only searched if asked
+        self.unscanned = []
+
+    def merge(self, child):
+        if child.img_found:
+            self.img_found = True
+        elif child.unscanned and not self.img_found:
+            self.unscanned.extend(child.unscanned)
+
+    def has_img(self):
+        if not self.img_found and self.unscanned:
+            self.img_found = any(
+                n.name == "img" or n.find("img") is not None for n in self.unscanned
+            )
+            self.unscanned = []
+        return self.img_found
+
+
+def html_to_typst(element, ctx):
+    # Iterative post-order walk over an explicit stack, so deeply nested
+    # articles neither pay a Python call per node nor hit the recursion limit.
+    # Frames are (node, list marker, parent's children, own children); own
+    # children is None until the node's children have been queued.
+    root = RenderedChildren()
+    stack = [(element, None, root, None)]
+    while stack:
+        node, marker, parent, own = stack.pop()
+        if own is not None:
+            content = "".join(own.parts)
+            parent.parts.append(render_end(node, content, ctx, own, marker))
+            parent.merge(own)
+            continue
+
+        if node.name == "img":
+            parent.img_found = True
+
+        # List items are always descended into, like their ul/ol handles them
+        if not marker:
+            result = render_start(node, ctx)
+            if result is not None:
+                parent.parts.append(result)
+                if node.name is not None:
+                    parent.unscanned.append(node)
+                continue
+
+        own = RenderedChildren()
+        stack.append((node, marker, parent, own))
+
+        children = node.contents
+        child_marker = None
+        if node.name in ["ul", "ol"]:
+            # Process list items directly; other children (whitespace) are dropped
+            child_marker = "-" if node.name == "ul" else "+"
+            own.unscanned = [c for c in children if c.name and c.name != "li"]
+            children = [child for child in children if child.name == "li"]
+
+        for child in reversed(children):
+            stack.append((child, child_marker, own, None))
+
+    return "".join(root.parts)
+
+
+def extract_metadata(soup):
+    # Metadata extraction (Title, Author, Date) - generic, with fallbacks
+    # Collect the <meta> tags in one pass instead of a search per property
+    meta = {}
+    for tag in soup.find_all("meta"):
+        for attr in ("property", "name"):
+            value = tag.get(attr)
+            if value and (attr, value) not in meta:
+                meta[(attr, value)] = tag
 
-    # Metadata extraction (Title, Author, Date) - moved early to be generic
     title = "Untitled"
-    meta_title = soup.find("meta", property="og:title")
+    meta_title = meta.get(("property", "og:title"))
     if meta_title:
         title = meta_title.get("content")
     else:
@@ -428,15 +823,18 @@ def scrape_url(url):
         title = title.replace(" | Quanta Magazine", "").strip()
 
     author = "Unknown Author"
-    meta_author = soup.find("meta", attrs={"name": "author"})
+    meta_author = meta.get(("name", "author"))
     if meta_author:
         author = meta_author.get("content")
 
+    # JSON-LD blocks, parsed at most once and shared by the author and date lookups
+    json_ld = None
+
     # Try JSON-LD for author if regex fallback is needed
     if author == "Unknown Author":
-        for script in soup.find_all("script", type="application/ld+json"):
+        json_ld = load_json_ld(soup)
+        for data in json_ld:
             try:
-                data = json.loads(script.string)
                 # Check graph if available
                 if "@graph" in data:
                     for item in data["@graph"]:
@@ -470,7 +868,7 @@ def scrape_url(url):
 
     if author == "Unknown Author":
         # Try generic bylines
-        author_elem = soup.find(class_=re.compile("author|byline", re.I))
+        author_elem = soup.find(class_=AUTHOR_CLASS_RE)
         if author_elem:
             author = author_elem.get_text(separator=" ", strip=True)
             # Cleanup common messy captures like "By Charlie Wood March 19..."
@@ -488,7 +886,7 @@ def scrape_url(url):
             # However, since we now use JSON-LD, Quanta should hit that branch and avoid this dirty scraping.
 
     date = ""
-    meta_date = soup.find("meta", property="article:published_time")
+    meta_date = meta.get(("property", "article:published_time"))
     if meta_date:
         date = meta_date.get("content")
     if not date:
@@ -502,9 +900,10 @@ def scrape_url(url):
 
     # Try JSON-LD if logic above failed
     if not date:
-        for script in soup.find_all("script", type="application/ld+json"):
+        if json_ld is None:
+            json_ld = load_json_ld(soup)
+        for data in json_ld:
             try:
-                data = json.loads(script.string)
                 # Check for datePublished in top level
                 if "datePublished" in data:
                     date = data["datePublished"]
@@ -523,6 +922,53 @@ def scrape_url(url):
     # Normalize date format
     date = format_date(date)
 
+    return title, author, date
+
+
+def scrape_url(url):
+    # Special handling for Quanta Magazine - force print mode
+    if "quantamagazine.org" in url and "print=1" not in url:
+        if "?" in url:
+            url += "&print=1"
+        else:
+            url += "?print=1"
+        print(f"Switching to print mode: {url}")
+
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+    }
+
+    # Check for Substack session cookie in environment variables
+    # You can set this by running: export SUBSTACK_COOKIE="...your_cookie_value..."
+    cookie_value = os.environ.get("SUBSTACK_COOKIE")
+    cookies = {}
+    if cookie_value:
+        cookies["substack.sid"] = cookie_value
+        print("Using provided SUBSTACK_COOKIE for authentication.")
+
+    if os.path.exists(url):
+        print(f"Reading local file: {url}")
+        with open(url, "r", encoding="utf-8") as f:
+            content = f.read()
+        soup = parse_html(content)
+        # Try to find canonical URL for base_url
+        canonical = soup.find("link", rel="canonical")
+        if canonical and canonical.get("href"):
+            url = canonical.get(
+                "href"
+            )  # Update url var to be the remote one for resolving relative links
+    else:
+        response = SESSION.get(url, headers=headers, cookies=cookies)
+        response.raise_for_status()
+        # Only trust the charset the server actually declared (Substack sends
+        # utf-8); requests otherwise guesses ISO-8859-1 for text/html
+        encoding = None
+        if "charset" in response.headers.get("content-type", "").lower():
+            encoding = response.encoding
+        soup = parse_html(response.content, encoding)
+
+    title, author, date = extract_metadata(soup)
+
     # Content Extraction Strategy
 
     # 1. Try Substack specific containers
@@ -559,15 +1005,20 @@ def scrape_url(url):
         # Create a dummy div to return empty processing
         content_div = soup.new_tag("div")
 
-    # Prepare footnotes extraction
-    global FOOTNOTES
-    FOOTNOTES = {}
+    footnotes_div = soup.find("div", class_="footnotes")
+
+    # Drop non-content subtrees up front so rendering never descends into them
+    strip_non_content(content_div)
+    if footnotes_div:
+        strip_non_content(footnotes_div)
+
+    # Prepare footnotes extraction. Definitions are only collected here and
+    # rendered when the walk first reaches a reference to them.
+    ctx = RenderContext(base_url=url)
 
     # Strategy: Find all elements that look like footnote definitions.
     # 1. Look for div.footnotes (Generic & Substack)
-    footnotes_div = soup.find(
-        "div", class_="footnotes"
-    )  # Standard class often used by markdown parsers
+    # (footnotes_div located above; standard class often used by markdown parsers)
     if footnotes_div:
         # Check for ordered list or list items
         items = footnotes_div.find_all("li")
@@ -576,66 +1027,41 @@ def scrape_url(url):
             if fid:
                 # Generic backref removal
                 # Remove by class
-                for backref in item.find_all(
-                    class_=re.compile(r"backref|footnote-back", re.I)
-                ):
+                for backref in item.find_all(class_=BACKREF_CLASS_RE):
                     backref.decompose()
                 # Remove by text symbol (↩, ↑) often used as backref
                 for link in item.find_all("a"):
                     if link.get_text(strip=True) in ["↩", "↑", "^", "return"]:
                         link.decompose()
 
-                FOOTNOTES[fid] = html_to_typst(item, url)
-                FOOTNOTES["#" + fid] = FOOTNOTES[fid]  # link format
-        footnotes_div.decompose()
+                ctx.footnote_sources[fid] = (item, False)
+        footnotes_div.extract()
 
     # 2. Look for substack specific footnote definitions (id="footnote-...")
-    definitions = content_div.find_all(attrs={"id": re.compile(r"footnote-.*")})
+    definitions = content_div.find_all(id=is_footnote_id)
     for defi in definitions:
         if defi.name == "a" and defi.get("href"):
             continue  # Skip links
 
-        text_len = len(defi.get_text(strip=True))
-        if text_len > 5:
+        # Skip definitions nested in one that was already taken out
+        if not any(parent is content_div for parent in defi.parents):
+            continue
+
+        if has_text_longer_than(defi, 5):
             fid = defi.get("id")
-            content_str = html_to_typst(defi, url)
-            content_str = re.sub(r"^\[?\d+\]?\s*", "", content_str)
-            FOOTNOTES[fid] = content_str
-            FOOTNOTES["#" + fid] = content_str
-            defi.decompose()
+            ctx.footnote_sources[fid] = (defi, True)
+            defi.extract()
 
     # Cleanup unwanted elements - Generic & Substack
-    unwanted_classes = [
-        # Substack
-        "share-dialog-title",
-        "share-button",
-        "subscription-widget-wrap",
-        "subscribe-widget",
-        "post-footer",
-        "comments-section",
-        "buttons",
-        "utility-bar",
-        "paywall-cta",
-        "share-post",
-        "post-footer-cta",
-        # Generic
-        "sidebar",
-        "hide--s",  # Mobile-specific content in Quanta
-        "nav",
-        "navigation",
-        "footer",
-        "menu",
-        "ad",
-        "advertisement",
-        "popup",
-        "newsletter-signup",
-    ]
-
-    # Remove unwanted classes
     if content_div:
-        for element in content_div.find_all():
-            # Check if element has attributes (skip strings, comments, etc.)
-            if getattr(element, "attrs", None) is None:
+        # Materialise the tags once; both passes below reuse the list
+        elements = content_div.find_all()
+
+        # Remove unwanted classes first, so the keyword pass below sees each
+        # container without the widgets nested inside it
+        for element in elements:
+            # Skip anything already removed along with an ancestor
+            if element.decomposed:
                 continue
 
             # element.get('class') returns a list of strings or None
@@ -643,36 +1069,49 @@ def scrape_url(url):
             if not classes:
                 continue
 
-            if any(cls in unwanted_classes for cls in classes):
+            if not UNWANTED_CLASSES.isdisjoint(classes):
                 element.decompose()
             # Also partial match checks for 'share', 'subscribe'
-            elif any(
+            elif element.name in ["div", "aside", "section"] and any(
                 "share" in cls.lower() or "subscribe" in cls.lower() for cls in classes
             ):
                 # Be careful not to delete content paragraphs that might have these words in class names arbitrarily?
                 # Safe for widgets Usually.
-                if element.name in ["div", "aside", "section"]:
-                    element.decompose()
+                element.decompose()
 
-    # Remove specific text buttons/links often found in body - Generic approach
-    if content_div:
-        for elem in content_div.find_all(["button", "a", "div", "p"]):
-            # Simplified logic: if short text and contains keywords
-            text = elem.get_text(strip=True).lower()
-            keywords = ["subscribe", "share", "leave a comment", "donate", "sign up"]
-
-            # Exact match or short phrases
-            if any(text == k for k in keywords) or (
-                len(text) < 50 and any(k in text for k in keywords)
+        # Remove specific text buttons/links often found in body - Generic approach
+        for element in elements:
+            if element.decomposed:
+                continue
+
+            # A div/p only qualifies if it is mostly empty/just this text, which is
+            # checked first so large containers never have their text collected
+            if element.name in ["button", "a"] or (
+                element.name in ["div", "p"] and len(element.find_all(limit=2)) <= 1
             ):
-                if elem.name in ["button", "a"]:
-                    elem.decompose()
-                # If div/p is mostly empty/just this text
-                elif elem.name in ["div", "p"] and len(elem.find_all()) <= 1:
-                    elem.decompose()
+                # Simplified logic: if short text and contains keywords
+                # (exact matches are short phrases too)
+                text = element.get_text(strip=True).lower()
+                if len(text) < 50 and any(k in text for k in CLEANUP_KEYWORDS):
+                    element.decompose()
+
+    # Start downloading the images the render walk will use, so the rest of
+    # the walk overlaps the network. Footnote definitions are only rendered
+    # once referenced, so only those reached through a link are included.
+    footnote_refs = []
+    image_urls = collect_image_urls(content_div, url, footnote_refs)
+    collected = set()
+    while footnote_refs:
+        fid = footnote_refs.pop()
+        if fid in collected or fid not in ctx.footnote_sources:
+            continue
+        collected.add(fid)
+        source, _ = ctx.footnote_sources[fid]
+        image_urls += collect_image_urls(source, url, footnote_refs)
+    prefetch_images(image_urls)
 
     # Pass 2: Rendering
-    typst_content = html_to_typst(content_div, url) if content_div else ""
+    typst_content = html_to_typst(content_div, ctx) if content_div else ""
 
     return {
         "title": title,
@@ -703,8 +1142,12 @@ def generate_typst_file(data, output_file="article.typ"):
   ]
 )
 """
-    with open(output_file, "w") as f:
-        f.write(template)
+    # Write the encoded file in one call and swap it into place, so an
+    # interrupted run never leaves a truncated .typ for typst to choke on
+    tmp_path = output_file + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(template.encode("utf-8"))
+    os.replace(tmp_path, output_file)
     print(f"Generated {output_file}")
 
 
@@ -729,8 +1172,8 @@ if __name__ == "__main__":
     print(f"Fetched: {data['title']}")
 
     # Create safe filename from title
-    safe_title = re.sub(r"[^\w\s-]", "", data["title"]).strip().lower()
-    safe_title = re.sub(r"[-\s]+", "-", safe_title)
+    safe_title = UNSAFE_FILENAME_RE.sub("", data["title"]).strip().lower()
+    safe_title = FILENAME_SEPARATOR_RE.sub("-", safe_title)
     if not safe_title:
         safe_title = "article"
 